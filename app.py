@@ -3,73 +3,264 @@
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import matplotlib.pyplot as plt
+from typing import TYPE_CHECKING, Optional
+from dataclasses import dataclass
 import sqlite3
-import json
+import dateutil.tz
+import orjson
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from pathlib import Path
+
+if TYPE_CHECKING:
+    import altair as alt
 
 # === DATABASE SETUP ===
 DB_FILE = "air_quality_plans.db"
 
+@st.cache_resource(show_spinner=False)
+def get_conn() -> sqlite3.Connection:
+    # One connection per process, shared across reruns and sessions (warm statement cache).
+    # Autocommit mode: multi-statement writes open their own BEGIN explicitly.
+    conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")  # Better for concurrent access
+    conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL; fsync at checkpoint, not every commit
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")  # ~20 MB page cache
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock() -> threading.Lock:
+    # The shared connection is used by every session and the fetch workers. Writes hold this lock so
+    # one thread's statement can't land inside (or collide with) another's explicit BEGIN…commit.
+    return threading.Lock()
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            city TEXT NOT NULL,
-            country TEXT,
-            activities TEXT NOT NULL,
-            plan_json TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    with get_write_lock():
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS plans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                city TEXT NOT NULL,
+                country TEXT,
+                activities TEXT NOT NULL,
+                plan_blob BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_plans_created_at ON plans(created_at DESC)")
+        # Databases created before plans were stored as Arrow still have plan_json;
+        # old rows keep their JSON text and are decoded as such on load
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(plans)")]
+        if "plan_json" in columns:
+            conn.execute("ALTER TABLE plans RENAME COLUMN plan_json TO plan_blob")
+        # Geocoding results per (city, country) — survive restarts so a city is looked up once
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                key TEXT PRIMARY KEY,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL
+            )
+        """)
+        # Last successful forecast per (city, country) — served when the live fetch fails
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS aqi_cache (
+                key TEXT PRIMARY KEY,
+                lat REAL,
+                lon REAL,
+                payload BLOB NOT NULL,
+                fetched_at TIMESTAMP NOT NULL
+            )
+        """)
+
+# pyarrow is imported inside the plan (de)serializers rather than at the top. The page's first
+# render doesn't need it, but the first forecast fetch does (the aqi_cache parquet payload).
+def _plan_to_blob(plan_df: pd.DataFrame) -> bytes:
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    table = pa.Table.from_pandas(plan_df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def _plan_from_blob(blob) -> pd.DataFrame:
+    if isinstance(blob, str):  # Legacy row saved with DataFrame.to_json()
+        return pd.read_json(StringIO(blob))
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    return pa.ipc.open_stream(pa.py_buffer(blob)).read_all().to_pandas()
 
 def save_plan(city: str, country: str, activities: list, plan_df: pd.DataFrame):
-    conn = sqlite3.connect(DB_FILE, timeout=10)
-    cursor = conn.cursor()
-    
-    # Force immediate write and better isolation
-    cursor.execute("PRAGMA synchronous = FULL")  # Ensures data is written to disk
-    cursor.execute("PRAGMA journal_mode = WAL")  # Better for concurrent access
-    
-    cursor.execute("""
-        INSERT INTO plans (city, country, activities, plan_json)
-        VALUES (?, ?, ?, ?)
-    """, (city, country or "", json.dumps(activities), plan_df.to_json()))
-    
-    conn.commit()        # Save changes
-    conn.execute("PRAGMA wal_checkpoint(FULL)")  # Force write-ahead log to disk
-    conn.close()
-    
+    row = (city, country or "", orjson.dumps(activities).decode(), _plan_to_blob(plan_df))
+    conn = get_conn()
+    with get_write_lock():
+        conn.execute("""
+            INSERT INTO plans (city, country, activities, plan_blob)
+            VALUES (?, ?, ?, ?)
+        """, row)
+        conn.execute("PRAGMA wal_checkpoint(FULL)")  # Fold the WAL into the main file so the backup download sees it
+
     st.success("✅ Plan saved to database!")
 
-def load_all_plans() -> pd.DataFrame:
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT id, city, country, activities, created_at FROM plans ORDER BY created_at DESC", conn)
-    conn.close()
-    if not df.empty:
-        df["activities"] = df["activities"].apply(lambda x: json.loads(x))
-    return df
+def save_plans_bulk(plans: list[tuple[str, str, list, pd.DataFrame]]):
+    """Insert many (city, country, activities, plan_df) rows with a single commit."""
+    rows = [
+        (city, country or "", orjson.dumps(activities).decode(), _plan_to_blob(plan_df))
+        for city, country, activities, plan_df in plans
+    ]
+    conn = get_conn()
+    with get_write_lock():
+        with conn:  # Commits on success, rolls back on error
+            conn.execute("BEGIN")  # Autocommit connection — open the batch transaction explicitly
+            conn.executemany("""
+                INSERT INTO plans (city, country, activities, plan_blob)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+        conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+PLAN_HISTORY_LIMIT = 200  # Most recent plans listed in the sidebar
+
+def load_plan_labels() -> list[tuple[int, str]]:
+    # Sidebar only needs (id, label) — no DataFrame, and activities are decoded in load_plan_by_id
+    return get_conn().execute(
+        "SELECT id, created_at || ' — ' || city FROM plans ORDER BY created_at DESC LIMIT ?",
+        (PLAN_HISTORY_LIMIT,),
+    ).fetchall()
+
+def count_plans() -> int:
+    return get_conn().execute("SELECT COUNT(*) FROM plans").fetchone()[0]
 
 def load_plan_by_id(plan_id: int) -> tuple[pd.DataFrame, list, str, str]:
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT city, country, activities, plan_json FROM plans WHERE id = ?", (plan_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = get_conn().execute("SELECT city, country, activities, plan_blob FROM plans WHERE id = ?", (plan_id,)).fetchone()
     if row:
-        city, country, activities_json, plan_json = row
-        activities = json.loads(activities_json)
-        plan_df = pd.read_json(plan_json)
+        city, country, activities_json, plan_blob = row
+        activities = orjson.loads(activities_json)
+        plan_df = _plan_from_blob(plan_blob)
         return plan_df, activities, city, country or ""
     return None, None, None, None
 
+AQI_CACHE_TTL = 1800  # Seconds a forecast counts as fresh (in memory and on disk)
+
+def _aqi_cache_key(city: str, country: str) -> str:
+    return f"{city.strip().lower()}|{country.strip().lower()}"
+
+def save_cached_aqi(city: str, country: str, lat: float, lon: float, df: pd.DataFrame):
+    row = (_aqi_cache_key(city, country), lat, lon, df.to_parquet(), datetime.now().isoformat(timespec="seconds"))
+    with get_write_lock():
+        get_conn().execute("INSERT OR REPLACE INTO aqi_cache (key, lat, lon, payload, fetched_at) VALUES (?, ?, ?, ?, ?)", row)
+
+def load_cached_aqi(city: str, country: str, max_age: Optional[float] = None) -> tuple[pd.DataFrame, str]:
+    """Last saved forecast for a city and when it was fetched; (None, None) if missing or older than max_age seconds."""
+    row = get_conn().execute(
+        "SELECT payload, fetched_at FROM aqi_cache WHERE key = ?", (_aqi_cache_key(city, country),)
+    ).fetchone()
+    if row:
+        payload, fetched_at = row
+        if max_age is None or (datetime.now() - datetime.fromisoformat(fetched_at)).total_seconds() < max_age:
+            return pd.read_parquet(BytesIO(payload)), fetched_at
+    return None, None
+
+def save_cached_coords(city: str, country: str, lat: float, lon: float):
+    with get_write_lock():
+        get_conn().execute(
+            "INSERT OR REPLACE INTO geocode_cache (key, lat, lon) VALUES (?, ?, ?)",
+            (_aqi_cache_key(city, country), lat, lon),
+        )
+
+def load_cached_coords(city: str, country: str) -> Optional[tuple[float, float]]:
+    return get_conn().execute(
+        "SELECT lat, lon FROM geocode_cache WHERE key = ?", (_aqi_cache_key(city, country),)
+    ).fetchone()
+
 # Initialize database on app start
 init_db()
 
+# === HTTP SESSION ===
+MAX_CONCURRENT_FETCHES = 8  # Cap on parallel OpenWeatherMap requests (rate limits)
+
+@st.cache_resource(show_spinner=False)
+def get_session() -> requests.Session:
+    # One keep-alive session shared by all OpenWeatherMap calls (geocode + forecast).
+    # Cached as a resource: a module-level Session would be rebuilt, and its pool dropped, on every rerun.
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=MAX_CONCURRENT_FETCHES,  # One pooled connection per concurrent fetch
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# === CIRCUIT BREAKER ===
+class CircuitOpenError(Exception):
+    """Raised instead of calling out while the breaker is open."""
+
+class CircuitBreaker:
+    """Fail fast after repeated OpenWeatherMap failures; probe again after a cooldown.
+
+    States: closed (normal) → open (short-circuit every call) → half_open (one probe).
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 60.0):
+        self.state = "closed"
+        self.fail_count = 0
+        self.opened_at = 0.0
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()  # Pool workers share one breaker
+
+    def call(self, fn):
+        with self._lock:
+            if self.state != "closed":
+                if time.monotonic() - self.opened_at < self.reset_after:
+                    raise CircuitOpenError(f"OpenWeatherMap circuit is {self.state}")
+                # Cooldown elapsed — this caller is the one probe. Restart the clock so everyone
+                # else keeps failing fast until it reports back (or, if it never does, another cooldown).
+                self.state = "half_open"
+                self.opened_at = time.monotonic()
+        try:
+            resp = fn()
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+        except Exception:
+            self._record_failure()
+            raise
+        with self._lock:
+            self.state = "closed"
+            self.fail_count = 0
+        return resp
+
+    def _record_failure(self):
+        with self._lock:
+            self.fail_count += 1
+            if self.state == "half_open" or self.fail_count >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+def get_breaker() -> CircuitBreaker:
+    # Every rerun re-executes this file and redefines CircuitBreaker / CircuitOpenError. Carry the
+    # stored breaker's state over to an instance of the current class, or the error it raises
+    # would be the previous run's CircuitOpenError and slip past `except CircuitOpenError`.
+    breaker = CircuitBreaker()
+    previous = st.session_state.get("owm_breaker")
+    if previous is not None:
+        breaker.__dict__.update(vars(previous))
+    st.session_state["owm_breaker"] = breaker
+    return breaker
+
 # === PAGE CONFIGURATION ===
 st.set_page_config(page_title="Air Quality Planner", layout="centered")
 st.title("🌤️ Air Quality Activity Planner")
@@ -78,20 +269,20 @@ st.markdown("Enter a city and your planned activities — get the **best times**
 # === SIDEBAR: View Saved Plans + Download Database ===
 with st.sidebar:
     st.header("📂 Saved Plans")
-    plans_history = load_all_plans()
-    if not plans_history.empty:
+    plan_labels = dict(load_plan_labels())
+    if plan_labels:
         selected_id = st.selectbox(
             "Choose a past plan to reload",
-            options=plans_history["id"].tolist(),
-            format_func=lambda pid: f"{plans_history[plans_history['id']==pid]['created_at'].values[0]} — {plans_history[plans_history['id']==pid]['city'].values[0]}"
+            options=list(plan_labels),
+            format_func=plan_labels.get
         )
         if st.button("Load Selected Plan"):
             plan, acts, city_name, country_name = load_plan_by_id(selected_id)
             if plan is not None:
-                st.session_state["loaded_plan"] = plan
-                st.session_state["loaded_activities"] = acts
-                st.session_state["loaded_city"] = city_name
-                st.session_state["loaded_country"] = country_name
+                # Seed the input widgets directly (they're created below, so this run can still set them)
+                st.session_state["city_input"] = city_name
+                st.session_state["country_input"] = country_name
+                st.session_state["activities_input"] = "\n".join(acts)
                 st.rerun()
     else:
         st.info("No saved plans yet. Generate and save one!")
@@ -113,149 +304,413 @@ with st.sidebar:
             mime="application/octet-stream",
             help="Complete backup of all your saved activity plans."
         )
-        st.info(f"Database contains {len(load_all_plans())} saved plan(s) · Size: {len(db_bytes)/1024:.1f} KB")
+        st.info(f"Database contains {count_plans()} saved plan(s) · Size: {len(db_bytes)/1024:.1f} KB")
     except FileNotFoundError:
         st.warning("No database yet — save your first plan to create it!")
     except Exception as e:
         st.error(f"Error: {e}")
 # === USER INPUTS ===
 col1, col2 = st.columns(2)
+# Keyed inputs: their values live in session_state, so a reloaded plan stays put across reruns
+st.session_state.setdefault("city_input", "London")
+st.session_state.setdefault("country_input", "UK")
+st.session_state.setdefault("activities_input", "\n".join(["Running outdoors", "Picnic in the park", "Indoor yoga", "Cycling"]))
 with col1:
-    default_city = st.session_state.get("loaded_city", "London")
-    city = st.text_input("City", value=default_city)
+    city = st.text_input("City", key="city_input")
 with col2:
-    default_country = st.session_state.get("loaded_country", "UK")
-    country = st.text_input("Country (optional)", value=default_country)
+    country = st.text_input(
+        "Country code (optional)",
+        key="country_input",
+        help="2- or 3-letter ISO code, e.g. GB or US — not the full country name.",
+    )
 
-default_activities = st.session_state.get("loaded_activities", ["Running outdoors", "Picnic in the park", "Indoor yoga", "Cycling"])
 activities_input = st.text_area(
     "Activities (one per line)",
-    value="\n".join(default_activities),
+    key="activities_input",
     height=150
 )
 activities = [line.strip() for line in activities_input.strip().split("\n") if line.strip()]
 
 # === AQI COLOR HELPER ===
-def aqi_color(aqi: int) -> str:
-    colors = ["#10b981", "#22c55e", "#f59e0b", "#ef4444", "#991b1b"]  # Good → Very Poor
-    return colors[aqi - 1] if 1 <= aqi <= 5 else "#gray"
+PALETTE = np.array(["#10b981", "#22c55e", "#f59e0b", "#ef4444", "#991b1b"])  # Good → Very Poor
+
+def aqi_colors(aqis) -> np.ndarray:
+    """Palette color for each AQI value (1 = Good … 5 = Very Poor), in one NumPy gather."""
+    return PALETTE[np.clip(np.asarray(aqis) - 1, 0, 4)]
 
 # === FETCH AIR QUALITY DATA FROM OPENWEATHERMAP ===
-@st.cache_data(ttl=1800)  # Cache for 30 minutes
-def get_aqi_data(city_name: str, country_code: str = "") -> tuple[pd.DataFrame, str]:
-    api_key = st.secrets["OPENWEATHER_API_KEY"]
+LEVELS = np.array(["Good", "Fair", "Moderate", "Poor", "Very Poor"])  # Indexed by AQI - 1
+GEO_URL = "http://api.openweathermap.org/geo/1.0/direct"
+FORECAST_URL = "http://api.openweathermap.org/data/2.5/air_pollution/forecast"
+OWM_TIMEOUT = (3, 7)  # (connect, read) seconds
+FORECAST_HOURS = 24
+
+@dataclass
+class AQIForecast:
+    """Hourly forecast as parallel arrays (struct of arrays) — what the plan logic works on.
 
-    # Step 1: Geocode city
-    geo_url = "http://api.openweathermap.org/geo/1.0/direct"
-    geo_params = {"q": f"{city_name},{country_code}".strip(","), "limit": 1, "appid": api_key}
+    A DataFrame is only built for the chart and the on-disk cache (to_df / from_df).
+    """
+    times: np.ndarray  # Hour labels, e.g. "3 PM"
+    aqi: np.ndarray  # int8, 1 = Good … 5 = Very Poor
+    fetched_at: float = 0.0  # Unix time the data came from OpenWeatherMap — ages are measured from here
+    stale_notice: Optional[str] = None  # Set when this is the saved fallback, not live data
+
+    @classmethod
+    def empty(cls) -> "AQIForecast":
+        return cls(np.array([], dtype=object), np.array([], dtype=np.int8))
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, fetched_at: str) -> "AQIForecast":
+        """Forecast from an aqi_cache payload and its fetched_at column (local ISO time)."""
+        return cls(
+            df["time"].astype(str).to_numpy(dtype=object),
+            df["aqi"].to_numpy(dtype=np.int8),
+            datetime.fromisoformat(fetched_at).timestamp(),
+        )
+
+    def good_times(self) -> np.ndarray:
+        return self.times[self.aqi <= 2]  # Good or Fair
+
+    def to_df(self) -> pd.DataFrame:
+        # Compact dtypes: 1-byte aqi, categorical labels
+        return pd.DataFrame({
+            "time": pd.Categorical(self.times, categories=pd.unique(self.times)),
+            "aqi": self.aqi,
+            "level": pd.Categorical.from_codes(self.aqi - 1, categories=LEVELS, ordered=True),
+        })
+
+class FetchError(Exception):
+    """Fetch failure carrying a user-facing message. Raised (not returned) so it is never cached."""
+
+class CityNotFoundError(Exception):
+    """The geocoder had no match. Raised (not returned) so a miss isn't cached for the life of the process."""
+
+CITIES_FILE = Path(__file__).with_name("cities.json")  # Pre-geocoded common cities, keyed like aqi_cache
+GEO_MEMO_SIZE = 512
+
+@st.cache_resource(show_spinner=False)
+def bundled_coords() -> dict[str, tuple[float, float]]:
     try:
-        geo_resp = requests.get(geo_url, params=geo_params, timeout=10).json()
+        return {key: tuple(coords) for key, coords in orjson.loads(CITIES_FILE.read_bytes()).items()}
+    except FileNotFoundError:
+        return {}
+
+@st.cache_resource(show_spinner=False)
+def _geo_memo() -> tuple[OrderedDict, threading.Lock]:
+    # Plain dict LRU shared by every session; a module-level dict would be reset on each rerun
+    return OrderedDict(), threading.Lock()
+
+def geocode(city_name: str, country_code: str, breaker: CircuitBreaker) -> Optional[tuple[float, float]]:
+    """Coordinates for a city, or None if it can't be found.
+
+    Hot lookups hit an in-process LRU (no argument hashing or pickling); misses fall
+    through to the st.cache_data / SQLite / HTTP chain in _geocode.
+    """
+    memo, lock = _geo_memo()
+    key = (city_name, country_code)
+    with lock:
+        if key in memo:
+            memo.move_to_end(key)
+            return memo[key]
+    try:
+        coords = _geocode(city_name, country_code, breaker)
+    except CityNotFoundError:
+        return None
+    with lock:
+        memo[key] = coords
+        if len(memo) > GEO_MEMO_SIZE:
+            memo.popitem(last=False)
+    return coords
+
+@st.cache_data(ttl=None, show_spinner=False)  # Cities don't move — keep found ones for the life of the process
+def _geocode(city_name: str, country_code: str, _breaker: CircuitBreaker) -> tuple[float, float]:
+    coords = bundled_coords().get(_aqi_cache_key(city_name, country_code))
+    if coords is None:
+        try:
+            coords = load_cached_coords(city_name, country_code)
+        except Exception:
+            pass  # Best-effort like the other cache reads (e.g. "database is locked") — ask the geocoder
+    if coords is not None:
+        return coords
+
+    geo_params = {"q": f"{city_name},{country_code}".strip(","), "limit": 1, "appid": st.secrets["OPENWEATHER_API_KEY"]}
+    try:
+        geo_resp = orjson.loads(_breaker.call(lambda: get_session().get(GEO_URL, params=geo_params, timeout=OWM_TIMEOUT)).content)
         if not geo_resp:
-            return None, "City not found. Try adding a country code."
+            raise CityNotFoundError(city_name)  # A typo or a transient empty reply — retried on the next lookup
         lat, lon = geo_resp[0]["lat"], geo_resp[0]["lon"]
+    except (CircuitOpenError, CityNotFoundError):
+        raise
+    except Exception as e:
+        raise FetchError("Failed to geocode city.") from e
+
+    try:
+        save_cached_coords(city_name, country_code, lat, lon)
     except Exception:
-        return None, "Failed to geocode city."
+        pass  # Persisting is best-effort; the in-memory cache still has it
+    return lat, lon
 
-    # Step 2: Get AQI forecast
-    aqi_url = "http://api.openweathermap.org/data/2.5/air_pollution/forecast"
-    aqi_params = {"lat": lat, "lon": lon, "appid": api_key}
+def fetch_forecast(lat: float, lon: float, breaker: CircuitBreaker) -> AQIForecast:
+    aqi_params = {"lat": lat, "lon": lon, "appid": st.secrets["OPENWEATHER_API_KEY"]}
     try:
-        data = requests.get(aqi_url, params=aqi_params, timeout=10).json()["list"][:24]  # Next 24 hours
-        rows = []
-        for entry in data:
-            dt = datetime.fromtimestamp(entry["dt"])
-            aqi = entry["main"]["aqi"]
-            level = ["Good", "Fair", "Moderate", "Poor", "Very Poor"][aqi - 1]
-            time_str = dt.strftime("%I %p").lstrip("0")  # e.g., "3 PM"
-            rows.append({"time": time_str, "aqi": aqi, "level": level})
-        return pd.DataFrame(rows), None
+        data = orjson.loads(breaker.call(lambda: get_session().get(FORECAST_URL, params=aqi_params, timeout=OWM_TIMEOUT)).content)["list"][:FORECAST_HOURS]
+        # Flatten the records once into columns, then work column-wise — no per-entry Python loop
+        flat = pd.json_normalize(data)
+        aqis = flat["main.aqi"].to_numpy()
+        if not ((aqis >= 1) & (aqis <= 5)).all():  # Checked here, not at render time in to_df()
+            raise ValueError(f"AQI outside 1-5: {aqis}")
+        aqis = aqis.astype(np.int8)
+        # One vectorized format call; shown in server-local time like datetime.fromtimestamp.
+        # tzlocal() follows DST across the 24 hours; a fixed offset from now() would not.
+        dts = pd.DatetimeIndex(pd.to_datetime(flat["dt"], unit="s", utc=True)).tz_convert(dateutil.tz.tzlocal())
+        times = dts.strftime("%I %p").str.lstrip("0")  # e.g., "3 PM"
+        return AQIForecast(times.to_numpy(dtype=object), aqis, time.time())
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        raise FetchError("Failed to fetch air quality data.") from e
+
+@st.cache_data(ttl=AQI_CACHE_TTL)  # Forecast refreshes every 30 minutes; geocode stays cached
+def _fetch_aqi_data(city_name: str, country_code: str, _breaker: CircuitBreaker) -> tuple[np.ndarray, np.ndarray, float]:
+    # Returns (times, aqi, fetched_at) rather than an AQIForecast: st.cache_data pickles the result, and a
+    # class defined in this script can't be pickled reliably once another rerun has redefined it.
+    # A forecast saved within the TTL (e.g. before a restart, or by another process) needs no network at all
+    try:
+        cached_df, fetched_at = load_cached_aqi(city_name, country_code, max_age=AQI_CACHE_TTL)
+    except Exception:
+        cached_df = None
+    if cached_df is not None:
+        forecast = AQIForecast.from_df(cached_df, fetched_at)
+        return forecast.times, forecast.aqi, forecast.fetched_at
+
+    coords = geocode(city_name, country_code, _breaker)
+    if coords is None:
+        raise FetchError("City not found. Try adding a country code.")  # Not cached: the next click asks again
+    forecast = fetch_forecast(*coords, _breaker)
+
+    try:
+        save_cached_aqi(city_name, country_code, *coords, forecast.to_df())
     except Exception:
-        return None, "Failed to fetch air quality data."
+        pass  # The fallback copy is best-effort; never fail a good fetch over it
+    return forecast.times, forecast.aqi, forecast.fetched_at
+
+def _fresh_aqi_data(city_name: str, country_code: str, breaker: CircuitBreaker) -> tuple[np.ndarray, np.ndarray, float]:
+    """_fetch_aqi_data, never older than AQI_CACHE_TTL.
+
+    st.cache_data's TTL runs from when it stored the result, which may already have been up to
+    a TTL old (read back from aqi_cache). Drop such an entry and fetch again.
+    """
+    times, aqi, fetched_at = _fetch_aqi_data(city_name, country_code, breaker)
+    if time.time() - fetched_at >= AQI_CACHE_TTL:
+        _fetch_aqi_data.clear(city_name, country_code, breaker)
+        times, aqi, fetched_at = _fetch_aqi_data(city_name, country_code, breaker)
+    return times, aqi, fetched_at
+
+def _aqi_result(fetch, city_name: str, country_code: str) -> tuple[AQIForecast, str]:
+    try:
+        return AQIForecast(*fetch()), None
+    except (CircuitOpenError, FetchError) as e:
+        error = "Service temporarily unavailable" if isinstance(e, CircuitOpenError) else str(e)
+
+    # Live fetch failed — fall back to the last good forecast for this city, if any
+    try:
+        cached_df, fetched_at = load_cached_aqi(city_name, country_code)
+    except Exception:
+        cached_df = None
+    if cached_df is None:
+        return None, error
+    forecast = AQIForecast.from_df(cached_df, fetched_at)
+    forecast.stale_notice = f"{error.rstrip('.')} — showing the last saved forecast from {fetched_at}."
+    return forecast, None
+
+# Letters required — "12345" isn't a city. Commas pass through to OWM's q=city,state,country ("Portland, OR")
+CITY_RE = re.compile(r"(?=.*[^\W\d_])[\w .,'\-]{2,60}")
+COUNTRY_RE = re.compile(r"[^\W\d_]{2,3}")  # ISO 3166 alpha-2 / alpha-3 code
+
+def validate_location(city_name: str, country_code: str) -> Optional[str]:
+    """User-facing error for input not worth a geocode request, or None if it looks valid."""
+    if not CITY_RE.fullmatch(city_name):
+        return "Please enter a valid city name."
+    if country_code and not COUNTRY_RE.fullmatch(country_code):
+        return "Country should be a 2- or 3-letter code (e.g. GB, US)."
+    return None
+
+def get_aqi_data(city_name: str, country_code: str = "") -> tuple[AQIForecast, str]:
+    city_name, country_code = city_name.strip(), (country_code or "").strip()
+    error = validate_location(city_name, country_code)
+    if error:
+        return None, error
+    breaker = get_breaker()
+    return _aqi_result(lambda: _fresh_aqi_data(city_name, country_code, breaker), city_name, country_code)
+
+@st.cache_resource(show_spinner=False)
+def _fetch_pool() -> ThreadPoolExecutor:
+    # Long-lived workers shared across reruns, like get_session()'s connection pool
+    # Bounded: at most MAX_CONCURRENT_FETCHES cities in flight; the rest queue
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES, thread_name_prefix="owm-fetch")
+
+def get_aqi_data_many(locations: list[tuple[str, str]]) -> list[tuple[AQIForecast, str]]:
+    """Fetch several (city, country) forecasts concurrently; results come back in input order.
+
+    Worker threads only do the network fetch — errors and the saved-forecast fallback are
+    handled back on the script thread. A fallback result carries its stale_notice for the caller to show.
+    """
+    locations = [(city_name.strip(), (country_code or "").strip()) for city_name, country_code in locations]
+    errors = [validate_location(city_name, country_code) for city_name, country_code in locations]
+    breaker = get_breaker()
+    pool = _fetch_pool()
+    futures = [None if error else pool.submit(_fresh_aqi_data, city_name, country_code, breaker)
+               for error, (city_name, country_code) in zip(errors, locations)]
+    return [(None, error) if error else _aqi_result(future.result, city_name, country_code)
+            for error, future, (city_name, country_code) in zip(errors, futures, locations)]
+
+# === AQI CHART ===
+LEGEND_HTML = """
+<div style="display:flex; gap:12px; margin:20px 0; font-weight:500;">
+  <span style="background:#10b981;color:white;padding:4px 10px;border-radius:4px;">Good</span>
+  <span style="background:#22c55e;color:white;padding:4px 10px;border-radius:4px;">Fair</span>
+  <span style="background:#f59e0b;color:black;padding:4px 10px;border-radius:4px;">Moderate</span>
+  <span style="background:#ef4444;color:white;padding:4px 10px;border-radius:4px;">Poor</span>
+  <span style="background:#991b1b;color:white;padding:4px 10px;border-radius:4px;">Very Poor</span>
+</div>
+<p><strong>Best for outdoor activities → Green/Fair</strong> | Avoid outdoors → Red</p>
+"""
+
+AXIS_LABEL_EXPR = f"{[''] + LEVELS.tolist()}[datum.value]"  # Vega expression: AQI 1-5 → level name
+
+def aqi_chart(df: pd.DataFrame) -> "alt.Chart":
+    import altair as alt  # Deferred like pyarrow — only needed once a chart is drawn
+
+    # Vega-Lite spec rendered in the browser — no server-side rasterizing
+    source = df.assign(color=aqi_colors(df["aqi"]))
+    return alt.Chart(source).mark_bar(stroke="black", strokeWidth=0.7).encode(
+        x=alt.X("time:N", sort=None, title="Time of Day", axis=alt.Axis(labelAngle=-45)),
+        y=alt.Y(
+            "aqi:Q",
+            scale=alt.Scale(domain=[0, 5]),
+            title="AQI Level",
+            axis=alt.Axis(values=[1, 2, 3, 4, 5], labelExpr=AXIS_LABEL_EXPR),
+        ),
+        color=alt.Color("color:N", scale=None),
+        tooltip=["time", "level"],
+    ).properties(height=320)
 
 # === RECOMMEND BEST TIMES ===
-def recommend_times(activities_list: list, df: pd.DataFrame) -> pd.DataFrame:
-    results = []
-    for activity in activities_list:
-        is_outdoor = any(word in activity.lower() for word in ["outdoor", "run", "jog", "cycle", "bike", "picnic", "hike", "walk", "garden", "sport"])
-        if is_outdoor:
-            good_times = df[df["aqi"] <= 2]["time"].tolist()  # Good or Fair
-            best_time = ", ".join(good_times) if good_times else "No safe time today"
-        else:
-            best_time = "Any time (indoor activity)"
-        results.append({"Activity": activity, "Best Time": best_time})
-    return pd.DataFrame(results)
+OUTDOOR_WORDS = ("outdoor", "run", "jog", "cycle", "bike", "picnic", "hike", "walk", "garden", "sport")
+WORD_START_ONLY = {"run"}  # Short enough to hide inside other words ("brunch"); the rest match anywhere ("Bicycle")
+# One alternation over all keywords: each activity is scanned once no matter how long the list grows.
+OUTDOOR_RE = re.compile(
+    "|".join(
+        rf"\b{re.escape(word)}" if word in WORD_START_ONLY else re.escape(word)
+        for word in sorted(OUTDOOR_WORDS, key=len, reverse=True)
+    ),
+    re.IGNORECASE,
+)
+
+def recommend_times(activities_list: list, forecast: AQIForecast) -> pd.DataFrame:
+    # Same answer for every outdoor activity — compute it once
+    good_times = ", ".join(forecast.good_times()) or "No safe time today"
+    # Two parallel column lists straight into the DataFrame (a handful of activities: a plain
+    # comprehension is cheaper than building a Series for .str.contains)
+    best_times = [good_times if OUTDOOR_RE.search(activity) else "Any time (indoor activity)"
+                  for activity in activities_list]
+    return pd.DataFrame({"Activity": activities_list, "Best Time": best_times})
+
+def plan_avg_aqi(plan: pd.DataFrame, forecast: AQIForecast) -> np.ndarray:
+    """Average AQI of each plan row's recommended times; 0 for rows with no specific times."""
+    time_to_aqi = dict(zip(forecast.times, forecast.aqi))
+    avgs = []
+    for best_time in plan["Best Time"]:
+        if best_time.startswith(("Any time", "No safe")):
+            avgs.append(0)
+            continue
+        matching = [time_to_aqi[t] for t in map(str.strip, best_time.split(",")) if t in time_to_aqi]
+        avgs.append(int(np.mean(matching)) if matching else 3)
+    return np.array(avgs, dtype=np.int8)
+
+def plan_row_styles(plan: pd.DataFrame, forecast: AQIForecast) -> np.ndarray:
+    """One CSS string per plan row, colored by the average AQI of its recommended times."""
+    avg = plan_avg_aqi(plan, forecast)
+    return np.where(avg > 0, np.char.add(np.char.add("background-color: ", aqi_colors(avg)), "; opacity: 0.8"), "")
+
+PLAN_CSV_CACHE_SIZE = 64  # Distinct plans kept; older ones are re-encoded if asked for again
+
+@st.cache_data(show_spinner=False, max_entries=PLAN_CSV_CACHE_SIZE)
+def plan_csv(plan: pd.DataFrame) -> bytes:
+    # Keyed on the plan's contents: reruns with an unchanged plan skip the CSV writer
+    return plan.to_csv(index=False, lineterminator="\n").encode()
 
 # === MAIN APP LOGIC ===
+# The last forecast is memoized in session_state under the (city, country) it was fetched
+# for, so reruns triggered by other widgets (sidebar, Save button) reuse it without
+# re-fetching or re-rendering the chart. A live forecast counts as current until AQI_CACHE_TTL
+# after OpenWeatherMap produced it (not after this session got it). A stale fallback is kept
+# for display only: the next click retries the live fetch.
+forecast_key = (city, country)
+memo = st.session_state.get("aqi_forecast") if st.session_state.get("_aqi_key") == forecast_key else None
+forecast_is_live = memo is not None and memo.stale_notice is None and time.time() - memo.fetched_at < AQI_CACHE_TTL
+forecast_is_current = forecast_is_live or (memo is not None and memo.stale_notice is not None)
+
+# Indoor-only plans don't depend on air quality — skip the forecast (and both API calls) entirely
+needs_aqi = any(OUTDOOR_RE.search(activity) for activity in activities)
+
 if st.button("Get Best Times", type="primary"):
     if not activities:
         st.error("Please enter at least one activity.")
     else:
-        with st.spinner("Fetching air quality forecast..."):
-            aqi_df, error = get_aqi_data(city, country)
+        st.session_state["_plan_key"] = forecast_key
+        if needs_aqi and not forecast_is_live:
+            with st.spinner("Fetching air quality forecast..."):
+                forecast, error = get_aqi_data(city, country)
             if error:
                 st.error(error)
+                st.session_state.pop("_aqi_key", None)
             else:
-                st.success(f"✅ Forecast loaded for **{city}**")
-
-                # AQI Chart
-                st.subheader("Air Quality Forecast (Next 24 Hours)")
-                fig, ax = plt.subplots(figsize=(11, 4.5))
-                ax.bar(aqi_df["time"], aqi_df["aqi"],
-                       color=[aqi_color(v) for v in aqi_df["aqi"]],
-                       edgecolor="black", linewidth=0.7)
-                ax.set_ylim(0, 5)
-                ax.set_yticks([1, 2, 3, 4, 5])
-                ax.set_yticklabels(["Good", "Fair", "Moderate", "Poor", "Very Poor"])
-                ax.set_ylabel("AQI Level")
-                ax.set_xlabel("Time of Day")
-                plt.xticks(rotation=45, ha="right")
-                plt.tight_layout()
-                st.pyplot(fig)
-
-                # Color Legend
-                st.markdown("""
-                <div style="display:flex; gap:12px; margin:20px 0; font-weight:500;">
-                  <span style="background:#10b981;color:white;padding:4px 10px;border-radius:4px;">Good</span>
-                  <span style="background:#22c55e;color:white;padding:4px 10px;border-radius:4px;">Fair</span>
-                  <span style="background:#f59e0b;color:black;padding:4px 10px;border-radius:4px;">Moderate</span>
-                  <span style="background:#ef4444;color:white;padding:4px 10px;border-radius:4px;">Poor</span>
-                  <span style="background:#991b1b;color:white;padding:4px 10px;border-radius:4px;">Very Poor</span>
-                </div>
-                <p><strong>Best for outdoor activities → Green/Fair</strong> | Avoid outdoors → Red</p>
-                """, unsafe_allow_html=True)
-
-                # Recommendation Table
-                st.subheader("Your Personalized Activity Plan")
-                plan = recommend_times(activities, aqi_df)
-
-                # Fixed row styling (prevents errors with "Any time" or "No safe time")
-                def style_row(row):
-                    best_time = row["Best Time"]
-                    if "Any time" in best_time or "No safe" in best_time:
-                        return [""] * len(row)
-                    times = [t.strip() for t in best_time.split(",")]
-                    matching = aqi_df[aqi_df["time"].isin(times)]["aqi"]
-                    avg_aqi = int(matching.mean()) if not matching.empty else 3
-                    color = aqi_color(avg_aqi)
-                    return [f"background-color: {color}; opacity: 0.8"] * len(row)
-
-                styled_plan = plan.style.apply(style_row, axis=1)
-                st.dataframe(styled_plan, hide_index=True, use_container_width=True)
-
-                # Save to DB & Download CSV
-                col1, col2 = st.columns(2)
-                with col1:
-                    if st.button("💾 Save This Plan to Database", type="secondary"):
-                        save_plan(city, country, activities, plan)
-                with col2:
-                    csv_data = plan.to_csv(index=False).encode()
-                    st.download_button(
-                        label="📄 Download Plan as CSV",
-                        data=csv_data,
-                        file_name=f"air_quality_plan_{city.lower()}_{datetime.now().strftime('%Y%m%d')}.csv",
-                        mime="text/csv"
-                    )
-
-                # Clear loaded session state after display
-                for key in ["loaded_plan", "loaded_activities", "loaded_city", "loaded_country"]:
-                    st.session_state.pop(key, None)
+                st.session_state["_aqi_key"] = forecast_key
+                st.session_state["aqi_forecast"] = forecast
+                forecast_is_current = True
+
+show_plan = activities and (
+    forecast_is_current if needs_aqi else st.session_state.get("_plan_key") == forecast_key
+)
+if show_plan:
+    if needs_aqi:
+        forecast = st.session_state["aqi_forecast"]
+        if forecast.stale_notice:
+            st.warning(forecast.stale_notice)
+        else:
+            st.success(f"✅ Forecast loaded for **{city}**")
+
+        # AQI Chart
+        st.subheader("Air Quality Forecast (Next 24 Hours)")
+        st.altair_chart(aqi_chart(forecast.to_df()), use_container_width=True)
+
+        # Color Legend
+        st.markdown(LEGEND_HTML, unsafe_allow_html=True)
+    else:
+        forecast = AQIForecast.empty()
+        st.info("All activities are indoor — no air quality forecast needed.")
+
+    # Recommendation Table
+    st.subheader("Your Personalized Activity Plan")
+    plan = recommend_times(activities, forecast)
+
+    # Fixed row styling (prevents errors with "Any time" or "No safe time")
+    row_styles = plan_row_styles(plan, forecast)
+    css = pd.DataFrame(np.repeat(row_styles[:, None], len(plan.columns), axis=1), index=plan.index, columns=plan.columns)
+    styled_plan = plan.style.apply(lambda _: css, axis=None)  # One call for the whole table, not one per row
+    st.dataframe(styled_plan, hide_index=True, use_container_width=True)
+
+    # Save to DB & Download CSV
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 Save This Plan to Database", type="secondary"):
+            save_plan(city, country, activities, plan)
+    with col2:
+        st.download_button(
+            label="📄 Download Plan as CSV",
+            data=plan_csv(plan),
+            file_name=f"air_quality_plan_{city.lower()}_{datetime.now().strftime('%Y%m%d')}.csv",
+            mime="text/csv"
+        )